@@ -1,5 +1,7 @@
+import threading
 from collections import defaultdict
-from typing import Generic, TypeVar, DefaultDict, Set, Optional, Dict
+from contextlib import contextmanager
+from typing import Generic, TypeVar, DefaultDict, Set, Optional, Dict, Iterator
 
 T = TypeVar('T')
 LT = TypeVar('LT')
@@ -138,3 +140,124 @@ class TwoClassesDict(Generic[LT, RT]):
         v = self._right_nodes[k]
         del self._right_nodes[k]
         del self._left_nodes[v]
+
+    def copy(self) -> 'TwoClassesDict[LT, RT]':
+        res = TwoClassesDict()  # type: TwoClassesDict[LT, RT]
+        res._left_nodes = self._left_nodes.copy()
+        res._right_nodes = self._right_nodes.copy()
+        return res
+
+
+class _FreezableTwoClassesDict(TwoClassesDict[LT, RT]):
+    def __init__(self, source: TwoClassesDict[LT, RT]):
+        super().__init__()
+        self._left_nodes = source._left_nodes.copy()
+        self._right_nodes = source._right_nodes.copy()
+        self._frozen = False
+
+    def freeze(self):
+        self._frozen = True
+
+    def _check_not_frozen(self):
+        if self._frozen:
+            raise TypeError('Published snapshot is read-only, modify it in a transaction()')
+
+    def set_edge(self, left_node: LT, right_node: RT):
+        self._check_not_frozen()
+        super().set_edge(left_node, right_node)
+
+    def remove_edge(self, left_node: LT, right_node: RT):
+        self._check_not_frozen()
+        super().remove_edge(left_node, right_node)
+
+    def remove_left_key(self, k: LT):
+        self._check_not_frozen()
+        super().remove_left_key(k)
+
+    def remove_right_key(self, k: RT):
+        self._check_not_frozen()
+        super().remove_right_key(k)
+
+
+class ConcurrentTwoClassesDict(Generic[LT, RT]):
+    """
+    TwoClassesDict whose readers never lock.
+    Readers see the published snapshot, which is read-only. Writers work on a copy under a lock and publish it
+    with a single attribute assignment, so a reader sees either none or all of a transaction.
+    Every write copies both dicts, so set_edge() and the other single-call writes are O(n) each:
+    batch writes with transaction() to pay for one copy only.
+    """
+
+    def __init__(self):
+        self._snapshot = _FreezableTwoClassesDict(TwoClassesDict())  # type: _FreezableTwoClassesDict[LT, RT]
+        self._snapshot.freeze()
+        self._write_lock = threading.Lock()
+        self._writer_thread = None  # type: Optional[int]
+
+    def snapshot(self) -> TwoClassesDict[LT, RT]:
+        """
+        Consistent read-only view for several reads.
+        """
+        return self._snapshot
+
+    @contextmanager
+    def transaction(self) -> Iterator[TwoClassesDict[LT, RT]]:
+        """
+        Yield a private copy to modify; it is published on exit unless an exception is raised.
+        The copy is read-only after the transaction. Transactions cannot be nested.
+        """
+        if self._writer_thread == threading.get_ident():
+            raise RuntimeError('Nested transaction is not supported')
+        with self._write_lock:
+            self._writer_thread = threading.get_ident()
+            staging = _FreezableTwoClassesDict(self._snapshot)
+            try:
+                yield staging
+                staging.freeze()
+                self._snapshot = staging
+            finally:
+                staging.freeze()
+                self._writer_thread = None
+
+    def get_from_left(self, k: LT) -> Set[RT]:
+        return self._snapshot.get_from_left(k)
+
+    def get_from_right(self, k: RT) -> Set[LT]:
+        return self._snapshot.get_from_right(k)
+
+    def get_first_from_left(self, k: LT, default: Optional[RT] = None) -> RT:
+        return self._snapshot.get_first_from_left(k, default)
+
+    def get_first_from_right(self, k: RT, default: Optional[LT] = None) -> LT:
+        return self._snapshot.get_first_from_right(k, default)
+
+    def has_edge(self, left_node: LT, right_node: RT):
+        return self._snapshot.has_edge(left_node, right_node)
+
+    def is_in_left(self, k: LT):
+        return self._snapshot.is_in_left(k)
+
+    def is_in_right(self, k: RT):
+        return self._snapshot.is_in_right(k)
+
+    def get_left_keys(self):
+        return self._snapshot.get_left_keys()
+
+    def get_right_keys(self):
+        return self._snapshot.get_right_keys()
+
+    def set_edge(self, left_node: LT, right_node: RT):
+        with self.transaction() as d:
+            d.set_edge(left_node, right_node)
+
+    def remove_edge(self, left_node: LT, right_node: RT):
+        with self.transaction() as d:
+            d.remove_edge(left_node, right_node)
+
+    def remove_left_key(self, k: LT):
+        with self.transaction() as d:
+            d.remove_left_key(k)
+
+    def remove_right_key(self, k: RT):
+        with self.transaction() as d:
+            d.remove_right_key(k)
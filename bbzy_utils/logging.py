@@ -1,19 +1,350 @@
+import inspect
+import itertools
+import json
 import logging
+import os
+import random
 import sys
+import threading
+import time
+import weakref
+from collections import deque
+from contextvars import ContextVar
+from functools import wraps
 from logging import Logger
-from typing import TextIO
+from typing import TextIO, Optional, Callable, Dict, Iterable, Any, Tuple, Deque, List
+
+# Offset turning perf_counter_ns() into wall-clock ns, so that spans recorded by different processes line up.
+_perf_to_wall_offset_ns = time.time_ns() - time.perf_counter_ns()
+# Span ids carry the pid in their high bits so that merged traces of several processes do not collide.
+_pid = os.getpid()
+_span_id_base = _pid << 32
+_span_ids = itertools.count(1)
+
+
+class Span:
+    __slots__ = ('span_id', 'parent_id', 'tag', 'start_ns', 'end_ns', 'pid', 'tid', 'error')
+
+    def __init__(self, tag: str, parent: Optional['Span']):
+        self.span_id = _span_id_base + next(_span_ids)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.tag = tag
+        self.start_ns = 0
+        self.end_ns = 0
+        self.pid = _pid
+        self.tid = threading.get_ident()
+        self.error = None  # type: Optional[str]
+
+    @property
+    def duration_ns(self) -> int:
+        return self.end_ns - self.start_ns
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'id': self.span_id,
+            'parent_id': self.parent_id,
+            'tag': self.tag,
+            'start_ns': self.start_ns + _perf_to_wall_offset_ns,
+            'duration_ns': self.duration_ns,
+            'pid': self.pid,
+            'tid': self.tid,
+            'error': self.error,
+        }
+
+    def to_chrome_event(self) -> Dict[str, Any]:
+        return {
+            'name': self.tag,
+            'ph': 'X',
+            'ts': (self.start_ns + _perf_to_wall_offset_ns) / 1000,
+            'dur': self.duration_ns / 1000,
+            'pid': self.pid,
+            'tid': self.tid,
+            'args': {'id': self.span_id, 'parent_id': self.parent_id, 'error': self.error},
+        }
+
+
+# (ContextLogger, span) of every block open in the current context, innermost last.
+# The span is None for blocks that are not sampled.
+_open_spans = ContextVar('bbzy_utils_open_spans', default=())  # type: ContextVar[Tuple[Tuple[Any, Optional[Span]], ...]]
+
+
+def current_span() -> Optional[Span]:
+    """
+    :return: None outside of any span, or inside a span that is not sampled
+    """
+    spans = _open_spans.get()
+    return spans[-1][1] if spans else None
+
+
+class TagStats:
+    """
+    Log-scaled duration histogram: 16 buckets per power of two, i.e. percentiles within ~6%.
+    Memory is bounded by the bucket count, not by the number of recorded durations.
+    """
+    _SUB_BITS = 4
+    _SUB_BUCKETS = 1 << _SUB_BITS
+
+    def __init__(self):
+        self._buckets = dict()  # type: Dict[int, int]
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = 0
+        self.max_ns = 0
+
+    @classmethod
+    def _bucket_index(cls, v: int) -> int:
+        shift = max(0, v.bit_length() - cls._SUB_BITS - 1)
+        return shift * cls._SUB_BUCKETS + (v >> shift)
+
+    @classmethod
+    def _bucket_bounds(cls, index: int) -> Tuple[int, int]:
+        shift = max(0, index // cls._SUB_BUCKETS - 1)
+        mantissa = index - shift * cls._SUB_BUCKETS
+        return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+    def add(self, duration_ns: int):
+        duration_ns = max(0, duration_ns)
+        index = self._bucket_index(duration_ns)
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+        if self.count == 0 or duration_ns < self.min_ns:
+            self.min_ns = duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+        self.count += 1
+        self.total_ns += duration_ns
+
+    def copy(self) -> 'TagStats':
+        res = TagStats()
+        res._buckets = self._buckets.copy()
+        res.count = self.count
+        res.total_ns = self.total_ns
+        res.min_ns = self.min_ns
+        res.max_ns = self.max_ns
+        return res
+
+    def percentile(self, q: float) -> int:
+        """
+        Nearest-rank percentile, as the middle of its bucket.
+        :param q: in [0, 100]
+        """
+        if not self.count:
+            raise ValueError('No duration recorded')
+        rank = max(1, -(-self.count * q // 100))
+        seen = 0
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen >= rank:
+                low, high = self._bucket_bounds(index)
+                return min(max((low + high) // 2, self.min_ns), self.max_ns)
+        return self.max_ns
+
+    def summary(self) -> Dict[str, int]:
+        return {
+            'count': self.count,
+            'total_ns': self.total_ns,
+            'min_ns': self.min_ns,
+            'p50_ns': self.percentile(50),
+            'p95_ns': self.percentile(95),
+            'p99_ns': self.percentile(99),
+            'max_ns': self.max_ns,
+        }
+
+
+# Every live recorder, to be reset in forked children.
+_span_recorders = weakref.WeakSet()  # type: weakref.WeakSet
+
+
+class SpanRecorder:
+    def __init__(self, max_spans: int = 0):
+        """
+        Per-tag stats are always kept. Spans themselves are only kept for export.
+        :param max_spans: how many of the latest spans to keep, 0 to keep none (export is then unavailable)
+        """
+        self._max_spans = max_spans
+        self._lock = threading.Lock()
+        self._spans = deque(maxlen=max_spans)  # type: Deque[Span]
+        self._stats = dict()  # type: Dict[str, TagStats]
+        _span_recorders.add(self)
+
+    def record(self, span: Span):
+        with self._lock:
+            stats = self._stats.get(span.tag)
+            if stats is None:
+                stats = self._stats[span.tag] = TagStats()
+            stats.add(span.duration_ns)
+            if self._max_spans:
+                self._spans.append(span)
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
+            self._stats = dict()
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._spans = deque(maxlen=self._max_spans)
+        self._stats = dict()
+
+    def get_spans(self) -> List[Span]:
+        with self._lock:
+            return list(self._spans)
+
+    def get_stats(self, tag: str) -> Optional[TagStats]:
+        """
+        :return: a copy of the stats of the tag
+        """
+        with self._lock:
+            stats = self._stats.get(tag)
+            return stats.copy() if stats is not None else None
+
+    def summary(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {tag: stats.summary() for tag, stats in self._stats.items()}
+
+    def _check_exportable(self):
+        if not self._max_spans:
+            raise ValueError('SpanRecorder keeps no span to export, set max_spans')
+
+    def export_json(self, path: str, **kwargs):
+        self._check_exportable()
+        data = {'spans': [i.to_dict() for i in self.get_spans()], 'stats': self.summary()}
+        with open(path, 'w') as fp:
+            json.dump(data, fp, **kwargs)
+
+    def export_chrome_trace(self, path: str):
+        """
+        Write a trace loadable by chrome://tracing or Perfetto.
+        Use merge_chrome_traces() to view the traces exported by several processes together.
+        """
+        self._check_exportable()
+        with open(path, 'w') as fp:
+            json.dump({'traceEvents': [i.to_chrome_event() for i in self.get_spans()]}, fp)
+
+
+def merge_chrome_traces(paths: Iterable[str], out_path: str):
+    """
+    ProcessPool(trace_dir=...) exports the trace of each worker; see ProcessPool.merge_traces().
+    """
+    events = list()
+    for path in paths:
+        with open(path, 'r') as fp:
+            events.extend(json.load(fp)['traceEvents'])
+    with open(out_path, 'w') as fp:
+        json.dump({'traceEvents': events}, fp)
+
+
+_global_span_recorder = SpanRecorder(max_spans=50000)
+
+
+def set_global_span_recorder(recorder: SpanRecorder):
+    global _global_span_recorder
+    _global_span_recorder = recorder
+
+
+def global_span_recorder() -> SpanRecorder:
+    return _global_span_recorder
+
+
+def _reset_spans_after_fork():
+    # Workers forked by ProcessPool must not re-export the spans of the parent process, nor reuse its ids.
+    global _pid, _span_id_base, _span_ids
+    _pid = os.getpid()
+    _span_id_base = _pid << 32
+    _span_ids = itertools.count(1)
+    for recorder in list(_span_recorders):
+        recorder._reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_spans_after_fork)
 
 
 class ContextLogger:
-    def __init__(self, logger: Logger, tag: str):
+    def __init__(
+            self,
+            logger: Optional[Logger],
+            tag: str,
+            *,
+            recorder: Optional[SpanRecorder] = None,
+            sample_rate: float = 1.0,
+    ):
+        """
+        Time a block as a span. Usable as a context manager, an async context manager or a decorator.
+        The same instance can be entered concurrently; the open spans are tracked per context.
+        Entering returns the span, or None if it is not sampled.
+        :param logger: None to record the span without logging
+        :param tag:
+        :param recorder: None for the global span recorder
+        :param sample_rate: probability of recording a root span; nested spans follow their root
+        """
         self._tag = tag
         self._logger = logger
+        self._recorder = recorder
+        self._sample_rate = sample_rate
+
+    def __enter__(self) -> Optional[Span]:
+        spans = _open_spans.get()
+        if spans:
+            parent = spans[-1][1]
+            sampled = parent is not None
+        else:
+            parent = None
+            sampled = self._sample_rate >= 1.0 or random.random() < self._sample_rate
+        if not sampled:
+            _open_spans.set(spans + ((self, None),))
+            return None
+        span = Span(self._tag, parent)
+        _open_spans.set(spans + ((self, span),))
+        if self._logger is not None:
+            self._logger.info(f'{self._tag} begin')
+        span.start_ns = time.perf_counter_ns()
+        return span
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end_ns = time.perf_counter_ns()
+        # Close the latest span opened by this instance, which is not the innermost one
+        # when spans do not close in order, e.g. around a yield.
+        spans = _open_spans.get()
+        for i in range(len(spans) - 1, -1, -1):
+            if spans[i][0] is self:
+                break
+        else:
+            raise RuntimeError(f'No open span for {self._tag}')
+        span = spans[i][1]
+        _open_spans.set(spans[:i] + spans[i + 1:])
+        if span is None:
+            return
+        span.end_ns = end_ns
+        if exc_type is not None:
+            span.error = exc_type.__name__
+        recorder = self._recorder if self._recorder is not None else _global_span_recorder
+        recorder.record(span)
+        if self._logger is not None:
+            self._logger.info(f'{self._tag} end ({span.duration_ns / 1e6:.3f} ms)')
+
+    async def __aenter__(self) -> Optional[Span]:
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return self.__exit__(exc_type, exc_val, exc_tb)
+
+    def __call__(self, func: Callable):
+        if inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func):
+            raise TypeError('Cannot time a generator function as a whole, time its consumer instead')
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_callback(*args, **kwargs):
+                async with self:
+                    return await func(*args, **kwargs)
+
+            return async_callback
 
-    def __enter__(self):
-        self._logger.info(f'{self._tag} begin')
+        @wraps(func)
+        def callback(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
 
-    def __exit__(self, *args):
-        self._logger.info(f'{self._tag} end')
+        return callback
 
 
 def init_logger(
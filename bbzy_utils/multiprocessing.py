@@ -1,12 +1,40 @@
+import glob
+import os
 from multiprocessing import Pool
 from multiprocessing.pool import AsyncResult
-from typing import List, Callable, Any, Iterator
+from multiprocessing.util import Finalize
+from typing import List, Callable, Any, Iterator, Optional
+
+from .logging import global_span_recorder, merge_chrome_traces
+
+
+def _export_worker_trace(path: str):
+    global_span_recorder().export_chrome_trace(path)
+
+
+def _init_traced_worker(trace_dir: str, initializer: Optional[Callable], initargs: tuple):
+    path = os.path.join(trace_dir, 'trace_{}.json'.format(os.getpid()))
+    # Run when the worker exits normally, i.e. after close() and join(), not after terminate().
+    Finalize(None, _export_worker_trace, args=(path,), exitpriority=0)
+    if initializer is not None:
+        initializer(*initargs)
 
 
 class ProcessPool:
-    def __init__(self, processors: int = None, **kwargs):
+    def __init__(self, processors: int = None, trace_dir: Optional[str] = None, **kwargs):
+        """
+        :param processors:
+        :param trace_dir: if set, every worker exports the Chrome trace of the global span recorder into this
+            directory when it exits; see merge_traces()
+        :param kwargs: passed to multiprocessing.Pool
+        """
         if __debug__ and processors is None:
             processors = 1
+        self._trace_dir = trace_dir
+        if trace_dir is not None:
+            os.makedirs(trace_dir, exist_ok=True)
+            kwargs['initargs'] = (trace_dir, kwargs.pop('initializer', None), kwargs.pop('initargs', ()))
+            kwargs['initializer'] = _init_traced_worker
         self._pool = Pool(processors, **kwargs)
         self._results = list()  # type: List[AsyncResult]
 
@@ -26,11 +54,25 @@ class ProcessPool:
     def check_exceptions(self) -> None:
         list(self.get_results())
 
+    def merge_traces(self, out_path: str):
+        """
+        Merge the traces of the workers and of this process into one Chrome trace.
+        Call it once the workers have exited, i.e. after join() or leaving the with block.
+        """
+        if self._trace_dir is None:
+            raise ValueError('ProcessPool was created without trace_dir')
+        global_span_recorder().export_chrome_trace(os.path.join(self._trace_dir, 'trace_{}.json'.format(os.getpid())))
+        merge_chrome_traces(sorted(glob.glob(os.path.join(self._trace_dir, 'trace_*.json'))), out_path)
+
     def __enter__(self):
         self._pool.__enter__()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._trace_dir is not None and exc_type is None:
+            # Let the workers exit normally so that they export their traces; terminate() would kill them.
+            self._pool.close()
+            self._pool.join()
         return self._pool.__exit__(exc_type, exc_val, exc_tb)
 
     def close(self):
@@ -1,5 +1,27 @@
+import hashlib
+import itertools
 import os
-from typing import Optional
+from typing import Optional, Set
+
+# Directories this process has already created (or found), so that repeated calls skip the stat/mkdir syscalls.
+# Paths are cached as given: call clear_created_dirs_cache() after os.chdir() when using relative paths,
+# or if directories may be removed behind our back.
+_created_dirs = set()  # type: Set[str]
+
+
+def _make_dirs(dir_path: str):
+    if dir_path in _created_dirs:
+        return
+    os.makedirs(dir_path, exist_ok=True)
+    _created_dirs.add(dir_path)
+
+
+def clear_created_dirs_cache():
+    _created_dirs.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=clear_created_dirs_cache)
 
 
 class DelayPathBase:
@@ -13,8 +35,7 @@ class DelayDirPath(DelayPathBase):
         self._dir_path = self.join(*dirs)
 
     def __call__(self, file_name: Optional[str] = None):
-        if not os.path.isdir(self._dir_path):
-            os.makedirs(self._dir_path, exist_ok=True)
+        _make_dirs(self._dir_path)
         if file_name is None:
             file_name = ''
         return self.join(self._dir_path, file_name)
@@ -26,14 +47,68 @@ class DelayDirPath(DelayPathBase):
         return DelayDirPath(self._dir_path, *dirs)
 
 
+class ShardedDirPath(DelayDirPath):
+    def __init__(self, *dirs, depth: int = 2, fan_out: int = 256):
+        """
+        Spread files across hashed subdirectories, e.g. `dirs/3f/a0/file_name` for depth=2, fan_out=256.
+        :param depth: levels of shard directories
+        :param fan_out: subdirectories per level
+        """
+        if depth < 1:
+            raise ValueError('depth should be at least 1')
+        if fan_out < 2:
+            raise ValueError('fan_out should be at least 2')
+        # Hash bits consumed by the shard levels, plus 32 bits to keep the last level uniform.
+        hash_bits = depth * (fan_out - 1).bit_length() + 32
+        if hash_bits > 512:
+            raise ValueError('depth={} and fan_out={} need more hash bits than available'.format(depth, fan_out))
+        super().__init__(*dirs)
+        self._depth = depth
+        self._fan_out = fan_out
+        self._name_width = len(format(fan_out - 1, 'x'))
+        self._digest_size = -(-hash_bits // 8)
+
+    def _shard_name(self, index: int) -> str:
+        return format(index, '0{}x'.format(self._name_width))
+
+    def get_shard_dir(self, file_name: str) -> str:
+        h = int.from_bytes(hashlib.blake2b(str(file_name).encode(), digest_size=self._digest_size).digest(), 'big')
+        parts = list()
+        for _ in range(self._depth):
+            h, index = divmod(h, self._fan_out)
+            parts.append(self._shard_name(index))
+        return self.join(self._dir_path, *parts)
+
+    def __call__(self, file_name: Optional[str] = None):
+        if file_name is None:
+            return super().__call__()
+        dir_path = self.get_shard_dir(file_name)
+        _make_dirs(dir_path)
+        return self.join(dir_path, file_name)
+
+    def delay_dir(self, *dirs):
+        return ShardedDirPath(self._dir_path, *dirs, depth=self._depth, fan_out=self._fan_out)
+
+    def make_all_shards(self, max_dirs: int = 1 << 20):
+        """
+        Create the fan_out ** depth shard directories at once.
+        :param max_dirs: raise ValueError rather than create more directories than this
+        """
+        count = self._fan_out ** self._depth
+        if count > max_dirs:
+            raise ValueError('{} shard directories exceed max_dirs={}'.format(count, max_dirs))
+        names = [self._shard_name(i) for i in range(self._fan_out)]
+        for parts in itertools.product(names, repeat=self._depth):
+            _make_dirs(self.join(self._dir_path, *parts))
+
+
 class DelayFilePath(DelayPathBase):
     def __init__(self, *paths):
         self._dir_path = self.join(*paths[:-1])
         self._full_path = self.join(self._dir_path, paths[-1])
 
     def __call__(self):
-        if not os.path.isdir(self._dir_path):
-            os.makedirs(self._dir_path, exist_ok=True)
+        _make_dirs(self._dir_path)
         return self._full_path
 
     def __str__(self):
@@ -43,12 +118,12 @@ class DelayFilePath(DelayPathBase):
 def join_dirs(*args, create_dirs=True):
     path = os.path.join(*args)
     if create_dirs:
-        os.makedirs(path, exist_ok=True)
+        _make_dirs(path)
     return path
 
 
 def join_file_path(*args, create_dirs=True):
     dir_path = os.path.join(*args[:-1])
     if create_dirs:
-        os.makedirs(dir_path, exist_ok=True)
+        _make_dirs(dir_path)
     return os.path.join(dir_path, args[-1])